@@ -4,6 +4,7 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import datetime
+import json
 import os
 from functools import wraps
 import google.oauth2.credentials
@@ -11,11 +12,14 @@ import google_auth_oauthlib.flow
 import googleapiclient.discovery
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError
+from cache import SharedCache
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///repeaters.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///repeaters.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')  # e.g. redis://localhost:6379/0
+app.config['CACHE_AUTHKEY'] = os.environ.get('CACHE_AUTHKEY')  # required for local://
 
 # Google Drive API configuration
 CLIENT_SECRETS_FILE = "client_secret.json"
@@ -25,6 +29,7 @@ API_VERSION = 'v3'
 
 CORS(app)
 db = SQLAlchemy(app)
+cache = SharedCache.from_url(app.config['CACHE_URL'], app.config['CACHE_AUTHKEY'])
 
 # Database Models
 class User(db.Model):
@@ -65,6 +70,11 @@ class Enrollment(db.Model):
     batch = db.Column(db.String(50))
     expiry_date = db.Column(db.DateTime)
 
+    # Lets the expiry sweeper find due rows without a full table scan
+    __table_args__ = (
+        db.Index('ix_enrollment_status_expiry', 'status', 'expiry_date'),
+    )
+
 class StudyMaterial(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
@@ -86,6 +96,46 @@ class Payment(db.Model):
     status = db.Column(db.String(20), default='pending')
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+    # Lets the archiver find old completed / stale pending rows by index
+    __table_args__ = (
+        db.Index('ix_payment_status_created', 'status', 'created_at'),
+    )
+
+# Archive Models (filled by maintenance.py)
+# On PostgreSQL these are range-partitioned by month of archived_at, so the
+# partition key has to be part of the primary key.
+class EnrollmentArchive(db.Model):
+    __tablename__ = 'enrollment_archive'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (archived_at)'}
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    archived_at = db.Column(db.DateTime, primary_key=True, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, nullable=False)
+    course_id = db.Column(db.Integer, nullable=False)
+    enrolled_at = db.Column(db.DateTime)
+    status = db.Column(db.String(20))
+    batch = db.Column(db.String(50))
+    expiry_date = db.Column(db.DateTime)
+
+class PaymentArchive(db.Model):
+    __tablename__ = 'payment_archive'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (archived_at)'}
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    archived_at = db.Column(db.DateTime, primary_key=True, default=datetime.datetime.utcnow)
+    user_id = db.Column(db.Integer, nullable=False)
+    course_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    payment_id = db.Column(db.String(100))
+    method = db.Column(db.String(50))
+    status = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime)
+
+class MaintenanceCheckpoint(db.Model):
+    job = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
 # Token authentication decorator
 def token_required(f):
     @wraps(f)
@@ -104,6 +154,12 @@ def token_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+# Cache keys touched by enrollment writes
+ENROLLMENT_CACHE_TTL = 30  # seconds; the enrolled:* key decides access to materials
+
+def enrollment_cache_keys(user_id, course_id):
+    return (f'enrolled:{user_id}:{course_id}', f'my-courses:{user_id}')
+
 # Routes
 @app.route('/')
 def home():
@@ -244,15 +300,14 @@ def google_auth():
 def get_courses():
     try:
         category = request.args.get('category')
-        query = Course.query
-        
-        if category:
-            query = query.filter_by(category=category)
         
-        courses = query.all()
-        
-        return jsonify({
-            'courses': [{
+        def load_courses():
+            query = Course.query
+            
+            if category:
+                query = query.filter_by(category=category)
+            
+            return [{
                 'id': course.id,
                 'name': course.name,
                 'code': course.code,
@@ -261,7 +316,10 @@ def get_courses():
                 'duration': course.duration,
                 'instructor': course.instructor,
                 'category': course.category
-            } for course in courses]
+            } for course in query.all()]
+        
+        return jsonify({
+            'courses': cache.get_or_set(f'courses:{category or ""}', load_courses)
         }), 200
         
     except Exception as e:
@@ -270,10 +328,9 @@ def get_courses():
 @app.route('/courses/<int:course_id>', methods=['GET'])
 def get_course(course_id):
     try:
-        course = Course.query.get_or_404(course_id)
-        
-        return jsonify({
-            'course': {
+        def load_course():
+            course = Course.query.get_or_404(course_id)
+            return {
                 'id': course.id,
                 'name': course.name,
                 'code': course.code,
@@ -283,6 +340,9 @@ def get_course(course_id):
                 'instructor': course.instructor,
                 'category': course.category
             }
+        
+        return jsonify({
+            'course': cache.get_or_set(f'course:{course_id}', load_course)
         }), 200
         
     except Exception as e:
@@ -317,6 +377,7 @@ def enroll_course(current_user):
         
         db.session.add(enrollment)
         db.session.commit()
+        cache.invalidate(*enrollment_cache_keys(current_user.id, course_id))
         
         return jsonify({
             'message': 'Successfully enrolled in course',
@@ -330,22 +391,26 @@ def enroll_course(current_user):
 @token_required
 def get_my_courses(current_user):
     try:
-        enrollments = Enrollment.query.filter_by(
-            user_id=current_user.id,
-            status='active'
-        ).all()
-        
-        courses = []
-        for enrollment in enrollments:
-            course = enrollment.course
-            courses.append({
-                'id': course.id,
-                'name': course.name,
-                'code': course.code,
-                'enrolled_at': enrollment.enrolled_at.isoformat(),
-                'batch': enrollment.batch,
-                'expiry_date': enrollment.expiry_date.isoformat() if enrollment.expiry_date else None
-            })
+        def load_my_courses():
+            enrollments = Enrollment.query.filter_by(
+                user_id=current_user.id,
+                status='active'
+            ).all()
+            
+            courses = []
+            for enrollment in enrollments:
+                course = enrollment.course
+                courses.append({
+                    'id': course.id,
+                    'name': course.name,
+                    'code': course.code,
+                    'enrolled_at': enrollment.enrolled_at.isoformat(),
+                    'batch': enrollment.batch,
+                    'expiry_date': enrollment.expiry_date.isoformat() if enrollment.expiry_date else None
+                })
+            return courses
+        
+        courses = cache.get_or_set(f'my-courses:{current_user.id}', load_my_courses)
         
         return jsonify({'courses': courses}), 200
         
@@ -358,19 +423,21 @@ def get_my_courses(current_user):
 def get_course_materials(current_user, course_id):
     try:
         # Check if user is enrolled
-        enrollment = Enrollment.query.filter_by(
-            user_id=current_user.id,
-            course_id=course_id,
-            status='active'
-        ).first()
+        enrolled = cache.get_or_set(
+            enrollment_cache_keys(current_user.id, course_id)[0],
+            lambda: Enrollment.query.filter_by(
+                user_id=current_user.id,
+                course_id=course_id,
+                status='active'
+            ).first() is not None,
+            ttl=ENROLLMENT_CACHE_TTL
+        )
         
-        if not enrollment and current_user.role != 'admin':
+        if not enrolled and current_user.role != 'admin':
             return jsonify({'error': 'Not enrolled in this course'}), 403
         
-        materials = StudyMaterial.query.filter_by(course_id=course_id).all()
-        
-        return jsonify({
-            'materials': [{
+        def load_materials():
+            return [{
                 'id': material.id,
                 'title': material.title,
                 'description': material.description,
@@ -378,7 +445,10 @@ def get_course_materials(current_user, course_id):
                 'file_type': material.file_type,
                 'uploaded_at': material.uploaded_at.isoformat(),
                 'size': material.size
-            } for material in materials]
+            } for material in StudyMaterial.query.filter_by(course_id=course_id).all()]
+        
+        return jsonify({
+            'materials': cache.get_or_set(f'materials:{course_id}', load_materials)
         }), 200
         
     except Exception as e:
@@ -497,6 +567,7 @@ def upload_to_drive(current_user):
         
         db.session.add(material)
         db.session.commit()
+        cache.invalidate(f'materials:{course_id}')
         
         return jsonify({
             'message': 'File uploaded successfully',
@@ -572,6 +643,7 @@ def verify_payment(current_user):
             )
             db.session.add(enrollment)
             db.session.commit()
+            cache.invalidate(*enrollment_cache_keys(current_user.id, payment.course_id))
             
             return jsonify({
                 'message': 'Payment verified and enrollment completed',
@@ -615,9 +687,17 @@ def get_stats(current_user):
     try:
         total_users = User.query.count()
         total_courses = Course.query.count()
-        total_enrollments = Enrollment.query.count()
-        total_payments = Payment.query.filter_by(status='completed').count()
-        revenue = db.session.query(db.func.sum(Payment.amount)).filter_by(status='completed').scalar() or 0
+        # Lifetime figures include rows moved out by maintenance.py
+        total_enrollments = Enrollment.query.count() + EnrollmentArchive.query.count()
+        total_payments = (Payment.query.filter_by(status='completed').count() +
+                          PaymentArchive.query.filter_by(status='completed').count())
+        revenue = ((db.session.query(db.func.sum(Payment.amount)).filter_by(status='completed').scalar() or 0) +
+                   (db.session.query(db.func.sum(PaymentArchive.amount)).filter_by(status='completed').scalar() or 0))
+        enrolled_users = db.union(
+            db.select(Enrollment.user_id),
+            db.select(EnrollmentArchive.user_id)
+        ).subquery()
+        active_users = db.session.query(db.func.count()).select_from(enrolled_users).scalar()
         
         return jsonify({
             'stats': {
@@ -626,7 +706,8 @@ def get_stats(current_user):
                 'total_enrollments': total_enrollments,
                 'total_payments': total_payments,
                 'total_revenue': revenue,
-                'active_users': Enrollment.query.distinct(Enrollment.user_id).count()
+                'active_users': active_users,
+                'cache': cache.stats()
             }
         }), 200
         
@@ -0,0 +1,473 @@
+"""Shared cache tier for The Repeaters Official API.
+
+Every worker keeps a small, short-lived local copy of hot entries in front of
+a cache shared by all workers. Writes call invalidate(), which removes the
+keys from the shared tier and broadcasts them so every worker drops its local
+copy straight away.
+
+The backend is picked from CACHE_URL:
+
+    redis://localhost:6379/0   Redis, or anything that speaks its protocol
+    local://127.0.0.1:6380     the in-box server (python cache.py serve)
+
+With CACHE_URL unset caching is off and every lookup goes to the database.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import (
+    Client, Listener, AuthenticationError, answer_challenge, deliver_challenge
+)
+from urllib.parse import urlparse
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+RECONNECT_DELAY = 1  # seconds
+DEFAULT_TIMEOUT = 0.5  # seconds before a lookup falls back to the database
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+SUBSCRIBER_QUEUE_SIZE = 1000
+TOMBSTONE_TTL = 60  # seconds an invalidation blocks writes from older loads
+
+# Wire format for the in-box server: JSON, never pickle
+def _send(conn, message):
+    conn.send_bytes(json.dumps(message).encode())
+
+def _recv(conn, timeout=None):
+    if timeout is not None and not conn.poll(timeout):
+        raise TimeoutError('Cache server did not answer in time')
+    return json.loads(conn.recv_bytes(MAX_MESSAGE_SIZE))
+
+def _connect(address, authkey, timeout):
+    conn = Client(address)
+    try:
+        # The server opens the handshake with its challenge
+        if not conn.poll(timeout):
+            raise TimeoutError('Cache server did not answer in time')
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+def _disconnect(conn):
+    # shutdown() also wakes a thread blocked sending on this connection
+    try:
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+    except OSError:
+        pass
+
+# In-box server
+class CacheServer:
+    def __init__(self, address, authkey, max_entries=100000):
+        # Authentication happens per connection in _handle, so a client
+        # stalling mid-handshake cannot hold up accept()
+        self.listener = Listener(address, backlog=128)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.max_entries = max_entries
+        self.data = {}  # key -> (value, expires_at)
+        self.version = 0  # bumped by every delete
+        self.tombstones = {}  # key -> (version it was deleted at, expires_at)
+        self.subscribers = {}  # connection -> queue of pending invalidations
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                continue
+            if self.closed:
+                conn.close()
+                self.listener.close()
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        commands = {'get': self.get, 'set': self.set, 'delete': self.delete}
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+            while True:
+                command, *args = _recv(conn)
+                if command == 'subscribe':
+                    self._serve_subscriber(conn)
+                    return
+                _send(conn, commands[command](*args))
+        except (EOFError, OSError, AuthenticationError, KeyError, TypeError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.closed = True
+        # Closing the socket would not wake accept(), so connect to it
+        try:
+            Client(self.address).close()
+        except OSError:
+            pass
+
+    def _serve_subscriber(self, conn):
+        pending = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[conn] = pending
+        # Only once registered can the client trust its local copies
+        _send(conn, ['subscribed'])
+        try:
+            while True:
+                _send(conn, pending.get())
+        finally:
+            with self.lock:
+                self.subscribers.pop(conn, None)
+
+    def get(self, key):
+        # The version goes back to the caller and comes along with its set()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return [None, self.version]
+            if entry[1] <= time.monotonic():
+                del self.data[key]
+                return [None, self.version]
+            return [entry[0], self.version]
+
+    def set(self, key, value, ttl, version):
+        now = time.monotonic()
+        with self.lock:
+            # Loaded before the key was last invalidated: would be stale
+            tombstone = self.tombstones.get(key)
+            if tombstone and tombstone[0] > version and tombstone[1] > now:
+                return False
+
+            if len(self.data) >= self.max_entries:
+                self.data = {k: v for k, v in self.data.items() if v[1] > now}
+                # Still full: drop the oldest entries
+                while len(self.data) >= self.max_entries:
+                    del self.data[next(iter(self.data))]
+            self.data[key] = (value, now + ttl)
+            return True
+
+    def delete(self, keys):
+        now = time.monotonic()
+        with self.lock:
+            self.version += 1
+            if len(self.tombstones) >= self.max_entries:
+                self.tombstones = {k: v for k, v in self.tombstones.items() if v[1] > now}
+            for key in keys:
+                self.data.pop(key, None)
+                self.tombstones[key] = (self.version, now + TOMBSTONE_TTL)
+            subscribers = list(self.subscribers.items())
+
+        # Each subscriber has its own sender thread, so a stalled one never
+        # holds the lock or the invalidating worker
+        for conn, pending in subscribers:
+            try:
+                pending.put_nowait(keys)
+            except queue.Full:
+                # Too far behind: cut it off so it drops its local copies
+                _disconnect(conn)
+
+class SocketBackend:
+    def __init__(self, address, authkey, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        # One connection per thread, so a slow server never queues request
+        # threads up behind each other
+        self._local = threading.local()
+
+    def _call(self, *message):
+        conn = getattr(self._local, 'conn', None)
+        # Connections are not shared with forked workers
+        if conn is None or self._local.pid != os.getpid():
+            conn = _connect(self.address, self.authkey, self.timeout)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        try:
+            _send(conn, message)
+            return _recv(conn, self.timeout)
+        except (EOFError, OSError, ValueError):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def get(self, key):
+        return self._call('get', key)
+
+    def set(self, key, value, ttl, version):
+        return self._call('set', key, value, ttl, version)
+
+    def delete(self, keys):
+        self._call('delete', list(keys))
+
+    def listen(self, on_invalidate, on_reset):
+        while True:
+            conn = None
+            try:
+                conn = _connect(self.address, self.authkey, self.timeout)
+                _send(conn, ['subscribe'])
+                if _recv(conn, self.timeout) != ['subscribed']:
+                    raise ValueError('Unexpected reply to subscribe')
+                on_reset(True)
+                while True:
+                    on_invalidate(_recv(conn))
+            except Exception as e:
+                # Never let the listener die quietly while local copies are served
+                logger.warning('Cache invalidation listener reconnecting: %s', e)
+                on_reset(False)
+                if conn is not None:
+                    conn.close()
+                time.sleep(RECONNECT_DELAY)
+
+# Redis adapter
+class RedisBackend:
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('CACHE_URL points at Redis but the redis package is not installed')
+        self.url = url
+        self.client = redis.Redis.from_url(
+            url,
+            socket_timeout=DEFAULT_TIMEOUT,
+            socket_connect_timeout=DEFAULT_TIMEOUT
+        )
+
+        # Only store if the key has not been invalidated since it was read
+        self._set_if_version = self.client.register_script(
+            "if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[3] then return 0 end "
+            "redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2]) "
+            "return 1"
+        )
+
+    @staticmethod
+    def _version_key(key):
+        return f'cache:version:{key}'
+
+    def get(self, key):
+        raw, version = self.client.mget(key, self._version_key(key))
+        return [
+            json.loads(raw) if raw is not None else None,
+            version.decode() if version is not None else '0'
+        ]
+
+    def set(self, key, value, ttl, version):
+        return bool(self._set_if_version(
+            keys=[key, self._version_key(key)],
+            args=[json.dumps(value), int(ttl * 1000), version]
+        ))
+
+    def delete(self, keys):
+        keys = list(keys)
+        pipe = self.client.pipeline()
+        pipe.delete(*keys)
+        for key in keys:
+            pipe.incr(self._version_key(key))
+            pipe.expire(self._version_key(key), TOMBSTONE_TTL)
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+        pipe.execute()
+
+    def listen(self, on_invalidate, on_reset):
+        # The subscription idles between messages, so it gets its own
+        # client without a read timeout
+        client = redis.Redis.from_url(self.url, socket_connect_timeout=DEFAULT_TIMEOUT)
+        while True:
+            pubsub = None
+            try:
+                pubsub = client.pubsub()
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    # Only once subscribed can the worker trust its local copies
+                    if message['type'] == 'subscribe':
+                        on_reset(True)
+                    elif message['type'] == 'message':
+                        on_invalidate(json.loads(message['data']))
+            except Exception as e:
+                logger.warning('Cache invalidation listener reconnecting: %s', e)
+                on_reset(False)
+                if pubsub is not None:
+                    pubsub.close()
+                time.sleep(RECONNECT_DELAY)
+
+def parse_address(url):
+    parsed = urlparse(url)
+    if parsed.hostname:
+        return (parsed.hostname, parsed.port)
+    return parsed.path  # unix socket
+
+def backend_from_url(url, authkey=None):
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    if scheme == 'local':
+        if not authkey:
+            raise RuntimeError('CACHE_AUTHKEY must be set to use the in-box cache server')
+        return SocketBackend(parse_address(url), authkey.encode())
+    raise ValueError(f'Unsupported CACHE_URL scheme: {scheme}')
+
+# Two-tier cache used by the app
+class SharedCache:
+    def __init__(self, backend=None, ttl=300, local_ttl=5, max_local_entries=10000):
+        self.backend = backend
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.max_local_entries = max_local_entries
+        self._local = {}  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._listening = False
+        self._generation = 0  # bumped whenever local copies are dropped
+        self._retry_at = 0  # backend is skipped until then after a failure
+        self._pending = set()  # invalidated keys the backend has not confirmed
+        self._pid = None
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_url(cls, url, authkey=None, **kwargs):
+        return cls(backend_from_url(url, authkey), **kwargs)
+
+    def _start_listener(self):
+        # Threads do not survive a fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._reset(False)
+        threading.Thread(
+            target=self.backend.listen,
+            args=(self._drop_local, self._reset),
+            daemon=True
+        ).start()
+
+    def _reset(self, listening):
+        # Anything cached locally may have missed an invalidation
+        with self._lock:
+            self._local.clear()
+            self._listening = listening
+            self._generation += 1
+
+    def _drop_local(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._local.pop(key, None)
+
+    def _failed(self, e):
+        # Circuit breaker: rather than every request waiting out the timeout,
+        # go straight to the database for a while
+        logger.warning('Shared cache unavailable: %s', e)
+        self._retry_at = time.monotonic() + RECONNECT_DELAY
+
+    def _flush(self):
+        """Send pending invalidations, returning True once none are left."""
+        with self._lock:
+            keys = list(self._pending)
+        if not keys:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self.backend.delete(keys)
+        except Exception as e:
+            self._failed(e)
+            return False
+        with self._lock:
+            self._pending.difference_update(keys)
+        return True
+
+    def get_or_set(self, key, loader, ttl=None):
+        """Return the cached value for key, calling loader() on a miss.
+
+        loader must return something JSON serialisable and not None.
+        """
+        if self.backend is None:
+            return loader()
+        self._start_listener()
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[1] > time.monotonic():
+                self.local_hits += 1
+                return entry[0]
+            generation = self._generation
+
+        # Until earlier invalidations went through, the shared tier may still
+        # hold what they were meant to remove
+        if not self._flush() or time.monotonic() < self._retry_at:
+            return loader()
+        try:
+            value, version = self.backend.get(key)
+        except Exception as e:
+            self._failed(e)
+            return loader()
+
+        if value is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            value = loader()
+            try:
+                stored = self.backend.set(key, value, ttl or self.ttl, version)
+            except Exception as e:
+                self._failed(e)
+                return value
+            if not stored:
+                # Invalidated while loading, so the value may already be stale
+                return value
+
+        with self._lock:
+            # Without the broadcast a local copy could go stale unnoticed, and
+            # an invalidation that arrived during the lookup may cover it
+            if self._listening and self._generation == generation:
+                if len(self._local) >= self.max_local_entries:
+                    self._local.clear()
+                self._local[key] = (value, time.monotonic() + self.local_ttl)
+        return value
+
+    def invalidate(self, *keys):
+        """Drop keys everywhere. Call after the write has been committed."""
+        if self.backend is None or not keys:
+            return
+        self._drop_local(keys)
+        # Kept until the backend confirms, and retried before the next lookup
+        with self._lock:
+            self._pending.update(keys)
+        self._flush()
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            'enabled': self.backend is not None,
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.local_hits + self.shared_hits) / lookups, 3) if lookups else 0.0
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the in-box shared cache server')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--url', default=os.environ.get('CACHE_URL', 'local://127.0.0.1:6380'))
+    args = parser.parse_args()
+
+    authkey = os.environ.get('CACHE_AUTHKEY')
+    if not authkey:
+        parser.error('CACHE_AUTHKEY must be set')
+    server = CacheServer(parse_address(args.url), authkey.encode())
+    print(f'Cache server listening on {args.url}')
+    server.serve_forever()
@@ -0,0 +1,222 @@
+"""Background maintenance jobs for The Repeaters Official API.
+
+Run once from cron, or keep it running as a worker with --loop:
+
+    python maintenance.py expire
+    python maintenance.py archive --payment-days 365 --pending-days 7
+    python maintenance.py all --loop 3600
+
+Every job walks its table in primary-key order, one short transaction per
+batch, and stores the last processed id in MaintenanceCheckpoint so a killed
+run picks up where it stopped.
+"""
+import argparse
+import datetime
+import time
+
+from app import (
+    app, db, cache, enrollment_cache_keys, Enrollment, Payment, EnrollmentArchive,
+    PaymentArchive, MaintenanceCheckpoint
+)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PAUSE = 0.1  # seconds to sleep between batches
+
+ENROLLMENT_COLUMNS = ['id', 'user_id', 'course_id', 'enrolled_at', 'status', 'batch', 'expiry_date']
+PAYMENT_COLUMNS = ['id', 'user_id', 'course_id', 'amount', 'payment_id', 'method', 'status', 'created_at']
+
+# Checkpoint helpers
+def _get_checkpoint(job):
+    checkpoint = MaintenanceCheckpoint.query.get(job)
+    return checkpoint.last_id if checkpoint else 0
+
+def _save_checkpoint(job, last_id):
+    db.session.merge(MaintenanceCheckpoint(
+        job=job,
+        last_id=last_id,
+        updated_at=datetime.datetime.utcnow()
+    ))
+
+def _ensure_indexes(model):
+    # create_all() skips tables that already exist, and their indexes with them
+    if db.engine.dialect.name != 'postgresql':
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        return
+
+    # A plain CREATE INDEX blocks writes to the table while it builds, so on
+    # PostgreSQL build concurrently, which cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for index in model.__table__.indexes:
+            # An interrupted concurrent build leaves an invalid index behind
+            valid = conn.execute(db.text(
+                'SELECT i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name'
+            ), {'name': index.name}).scalar()
+            if valid is False:
+                conn.execute(db.text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+
+            columns = ', '.join(column.name for column in index.columns)
+            conn.execute(db.text(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} '
+                f'ON {model.__tablename__} ({columns})'
+            ))
+
+def _run_batches(job, model, criteria, process_batch, batch_size, pause, after_commit=None):
+    _ensure_indexes(model)
+    last_id = _get_checkpoint(job)
+    processed = 0
+    started = time.monotonic()
+
+    try:
+        while True:
+            ids = [row.id for row in model.query
+                   .with_entities(model.id)
+                   .filter(model.id > last_id, *criteria)
+                   .order_by(model.id)
+                   .limit(batch_size)]
+            if not ids:
+                break
+
+            # The batch and its checkpoint commit together
+            processed += process_batch(ids)
+            last_id = ids[-1]
+            _save_checkpoint(job, last_id)
+            db.session.commit()
+            if after_commit:
+                after_commit()
+
+            if pause:
+                time.sleep(pause)
+
+        # Finished a full pass, so the next run starts from the beginning
+        MaintenanceCheckpoint.query.filter_by(job=job).delete()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    elapsed = time.monotonic() - started
+    return {
+        'job': job,
+        'rows': processed,
+        'seconds': round(elapsed, 2),
+        'rows_per_second': round(processed / elapsed, 1) if elapsed else float(processed)
+    }
+
+# Enrollment expiry
+def expire_enrollments(batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE):
+    now = datetime.datetime.utcnow()
+    criteria = [Enrollment.status == 'active', Enrollment.expiry_date < now]
+    table = Enrollment.__table__
+    stale_keys = set()
+
+    def expire(ids):
+        rows = db.session.execute(
+            table.update()
+            .where(table.c.id.in_(ids), *criteria)
+            .values(status='expired')
+            .returning(table.c.user_id, table.c.course_id)
+        ).all()
+        for user_id, course_id in rows:
+            stale_keys.update(enrollment_cache_keys(user_id, course_id))
+        return len(rows)
+
+    def invalidate():
+        cache.invalidate(*stale_keys)
+        stale_keys.clear()
+
+    return _run_batches('expire_enrollments', Enrollment, criteria, expire, batch_size, pause,
+                        after_commit=invalidate)
+
+# Archival
+def _ensure_partition(archive_model, archived_at):
+    # Archive tables are only partitioned on PostgreSQL
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    start = archived_at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    table = archive_model.__tablename__
+    db.session.execute(db.text(
+        f"CREATE TABLE IF NOT EXISTS {table}_{start:%Y_%m} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+    ))
+    db.session.commit()
+
+def _archive(job, model, archive_model, columns, criteria, batch_size, pause):
+    archived_at = datetime.datetime.utcnow()
+    _ensure_partition(archive_model, archived_at)
+    source = model.__table__
+
+    def move(ids):
+        # DELETE ... RETURNING re-checks the criteria, so rows changed since
+        # the batch was selected stay where they are
+        rows = db.session.execute(
+            source.delete()
+            .where(source.c.id.in_(ids), *criteria)
+            .returning(*[source.c[name] for name in columns])
+        ).mappings().all()
+        if rows:
+            db.session.execute(
+                archive_model.__table__.insert(),
+                [dict(row, archived_at=archived_at) for row in rows]
+            )
+        return len(rows)
+
+    return _run_batches(job, model, criteria, move, batch_size, pause)
+
+def archive_payments(completed_days=365, pending_days=7,
+                     batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE):
+    now = datetime.datetime.utcnow()
+    criteria = [db.or_(
+        db.and_(Payment.status == 'completed',
+                Payment.created_at < now - datetime.timedelta(days=completed_days)),
+        db.and_(Payment.status == 'pending',
+                Payment.created_at < now - datetime.timedelta(days=pending_days))
+    )]
+    return _archive('archive_payments', Payment, PaymentArchive, PAYMENT_COLUMNS,
+                    criteria, batch_size, pause)
+
+def archive_enrollments(expired_days=90, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=expired_days)
+    criteria = [Enrollment.status == 'expired', Enrollment.expiry_date < cutoff]
+    return _archive('archive_enrollments', Enrollment, EnrollmentArchive, ENROLLMENT_COLUMNS,
+                    criteria, batch_size, pause)
+
+def run_jobs(job, args):
+    results = []
+    if job in ('expire', 'all'):
+        results.append(expire_enrollments(args.batch_size, args.pause))
+    if job in ('archive', 'all'):
+        results.append(archive_payments(args.payment_days, args.pending_days,
+                                        args.batch_size, args.pause))
+        results.append(archive_enrollments(args.enrollment_days, args.batch_size, args.pause))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expire enrollments and archive old rows')
+    parser.add_argument('job', choices=['expire', 'archive', 'all'])
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE,
+                        help='seconds to sleep between batches')
+    parser.add_argument('--payment-days', type=int, default=365,
+                        help='archive completed payments older than this')
+    parser.add_argument('--pending-days', type=int, default=7,
+                        help='archive pending payments older than this')
+    parser.add_argument('--enrollment-days', type=int, default=90,
+                        help='archive enrollments expired for longer than this')
+    parser.add_argument('--loop', type=int, default=0,
+                        help='repeat every N seconds instead of running once')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+
+        while True:
+            for stats in run_jobs(args.job, args):
+                print(f"{stats['job']}: {stats['rows']} rows in {stats['seconds']}s "
+                      f"({stats['rows_per_second']} rows/s)")
+            if not args.loop:
+                break
+            time.sleep(args.loop)
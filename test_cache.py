@@ -0,0 +1,159 @@
+import multiprocessing
+import socket
+import threading
+import time
+
+import pytest
+
+import cache as cache_module
+from cache import CacheServer, SharedCache, backend_from_url
+
+AUTHKEY = 'test-cache-key'
+
+@pytest.fixture
+def cache_url():
+    # In-box server on an ephemeral port, standing in for Redis
+    server = CacheServer(('127.0.0.1', 0), AUTHKEY.encode())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'local://%s:%d' % server.address
+    server.close()
+    thread.join(timeout=5)
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
+
+def worker(url, commands, results):
+    cache = SharedCache.from_url(url, AUTHKEY)
+    cache._start_listener()
+    wait_until(lambda: cache._listening)
+    results.put('ready')
+
+    for action, key, fallback in iter(commands.get, None):
+        if action == 'cached_locally':
+            results.put(key in cache._local)
+        else:
+            results.put(cache.get_or_set(key, lambda: fallback))
+    results.put(cache.stats())
+
+def test_workers_stay_coherent_after_invalidate(cache_url):
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for _ in range(3):
+        commands, results = context.Queue(), context.Queue()
+        process = context.Process(target=worker, args=(cache_url, commands, results), daemon=True)
+        process.start()
+        workers.append((process, commands, results))
+    for _, _, results in workers:
+        assert results.get(timeout=30) == 'ready'
+
+    def ask(index, fallback, action='get'):
+        _, commands, results = workers[index]
+        commands.put((action, 'course:1', fallback))
+        return results.get(timeout=5)
+
+    # One load from the database, shared with the others
+    assert ask(0, 'v1') == 'v1'
+    assert ask(1, 'unused') == 'v1'
+    assert ask(2, 'unused') == 'v1'
+    # Served from each worker's local copy
+    assert [ask(i, 'unused') for i in range(3)] == ['v1', 'v1', 'v1']
+
+    SharedCache.from_url(cache_url, AUTHKEY).invalidate('course:1')
+    wait_until(lambda: not any(ask(i, None, 'cached_locally') for i in range(3)))
+
+    assert ask(0, 'v2') == 'v2'
+    assert ask(1, 'unused') == 'v2'
+    assert ask(2, 'unused') == 'v2'
+
+    stats = []
+    for process, commands, results in workers:
+        commands.put(None)
+        stats.append(results.get(timeout=5))
+        process.join(timeout=5)
+
+    assert stats[0] == {'enabled': True, 'local_hits': 1, 'shared_hits': 0, 'misses': 2, 'hit_rate': 0.333}
+    for worker_stats in stats[1:]:
+        assert worker_stats == {'enabled': True, 'local_hits': 1, 'shared_hits': 2, 'misses': 0, 'hit_rate': 1.0}
+
+def test_value_loaded_before_invalidate_is_not_stored(cache_url):
+    reader = SharedCache.from_url(cache_url, AUTHKEY)
+    writer = SharedCache.from_url(cache_url, AUTHKEY)
+
+    def stale_loader():
+        # A write commits and invalidates while this request is still loading
+        writer.invalidate('enrolled:1:1')
+        return False
+
+    assert reader.get_or_set('enrolled:1:1', stale_loader) is False
+    assert reader.get_or_set('enrolled:1:1', lambda: True) is True
+    assert writer.get_or_set('enrolled:1:1', lambda: 'unused') is True
+
+def test_failed_invalidation_is_retried(cache_url, monkeypatch):
+    monkeypatch.setattr(cache_module, 'RECONNECT_DELAY', 0)
+    reader = SharedCache.from_url(cache_url, AUTHKEY)
+    writer = SharedCache.from_url(cache_url, AUTHKEY)
+    assert reader.get_or_set('enrolled:1:1', lambda: False) is False
+
+    # The first delete is lost on the way to the server
+    delete = writer.backend.delete
+    def failing_delete(keys):
+        monkeypatch.setattr(writer.backend, 'delete', delete)
+        raise OSError('connection reset')
+    monkeypatch.setattr(writer.backend, 'delete', failing_delete)
+    writer.invalidate('enrolled:1:1')
+
+    # The writer's next lookup sends it again before reading the shared tier
+    assert writer.get_or_set('enrolled:1:1', lambda: True) is True
+    assert reader.get_or_set('enrolled:1:1', lambda: 'unused') is True
+
+def test_hung_server_falls_back_to_loader():
+    # Accepts connections but never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    cache = SharedCache.from_url('local://127.0.0.1:%d' % listener.getsockname()[1], AUTHKEY)
+
+    started = time.monotonic()
+    assert cache.get_or_set('course:1', lambda: 'from-db') == 'from-db'
+    assert time.monotonic() - started < 2
+    listener.close()
+
+def test_concurrent_lookups_against_hung_server_fail_fast():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    cache = SharedCache.from_url('local://127.0.0.1:%d' % listener.getsockname()[1], AUTHKEY)
+    latencies = []
+
+    def request():
+        # Two lookups, as /materials makes
+        started = time.monotonic()
+        cache.get_or_set('enrolled:1:1', lambda: True)
+        cache.get_or_set('materials:1', lambda: [])
+        latencies.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each waits out one timeout at most, in parallel, then the breaker opens
+    assert len(latencies) == 8
+    assert max(latencies) < 1
+    listener.close()
+
+def test_wrong_authkey_falls_back_to_loader(cache_url):
+    cache = SharedCache.from_url(cache_url, 'wrong-key')
+    assert cache.get_or_set('course:1', lambda: 'from-db') == 'from-db'
+    assert cache.stats()['misses'] == 0
+
+def test_local_backend_requires_authkey():
+    with pytest.raises(RuntimeError):
+        backend_from_url('local://127.0.0.1:6380')
+    assert backend_from_url(None) is None
@@ -0,0 +1,136 @@
+import datetime
+import os
+
+import pytest
+
+# In-memory database, set before app is imported
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+import maintenance
+from app import (
+    app, db, User, Course, Enrollment, Payment, EnrollmentArchive, PaymentArchive,
+    MaintenanceCheckpoint, enrollment_cache_keys
+)
+
+NOW = datetime.datetime.utcnow()
+
+def days_ago(days):
+    return NOW - datetime.timedelta(days=days)
+
+@pytest.fixture
+def session():
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, name='Student', email='student@example.com', password='x'))
+        db.session.add(Course(id=1, name='SSC CGL', code='SSC-CGL', price=1))
+        db.session.commit()
+        yield db.session
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def invalidated(monkeypatch):
+    keys = []
+    monkeypatch.setattr(maintenance.cache, 'invalidate', lambda *k: keys.extend(k))
+    return keys
+
+def add_enrollments(session, *rows):
+    enrollments = [Enrollment(user_id=1, course_id=course_id, status=status, expiry_date=expiry)
+                   for course_id, status, expiry in rows]
+    session.add_all(enrollments)
+    session.commit()
+    return [enrollment.id for enrollment in enrollments]
+
+def statuses():
+    return {e.id: e.status for e in Enrollment.query.order_by(Enrollment.id)}
+
+def test_expire_only_due_active_enrollments(session, invalidated):
+    due, future, no_expiry, cancelled = add_enrollments(
+        session,
+        (1, 'active', days_ago(1)),
+        (2, 'active', days_ago(-30)),
+        (3, 'active', None),
+        (4, 'cancelled', days_ago(1))
+    )
+
+    stats = maintenance.expire_enrollments(pause=0)
+
+    assert stats['rows'] == 1
+    assert statuses() == {due: 'expired', future: 'active', no_expiry: 'active', cancelled: 'cancelled'}
+    assert sorted(invalidated) == sorted(enrollment_cache_keys(1, 1))
+
+def test_archive_payments_by_status_and_age(session):
+    payments = {
+        'old-completed': Payment(user_id=1, course_id=1, amount=10, status='completed', created_at=days_ago(400)),
+        'new-completed': Payment(user_id=1, course_id=1, amount=10, status='completed', created_at=days_ago(10)),
+        'stale-pending': Payment(user_id=1, course_id=1, amount=10, status='pending', created_at=days_ago(30)),
+        'new-pending': Payment(user_id=1, course_id=1, amount=10, status='pending', created_at=days_ago(1))
+    }
+    for payment_id, payment in payments.items():
+        payment.payment_id = payment_id
+    session.add_all(payments.values())
+    session.commit()
+
+    stats = maintenance.archive_payments(completed_days=365, pending_days=7, pause=0)
+
+    assert stats['rows'] == 2
+    assert {p.payment_id for p in Payment.query} == {'new-completed', 'new-pending'}
+    archived = PaymentArchive.query.all()
+    assert {p.payment_id for p in archived} == {'old-completed', 'stale-pending'}
+    assert all(p.archived_at is not None for p in archived)
+
+def test_archive_long_expired_enrollments(session):
+    old, recent, active = add_enrollments(
+        session,
+        (1, 'expired', days_ago(200)),
+        (2, 'expired', days_ago(10)),
+        (3, 'active', days_ago(200))
+    )
+
+    maintenance.archive_enrollments(expired_days=90, pause=0)
+
+    assert set(statuses()) == {recent, active}
+    assert [e.id for e in EnrollmentArchive.query] == [old]
+
+def test_resume_from_checkpoint_after_failed_batch(session, invalidated, monkeypatch):
+    ids = add_enrollments(session, *[(course_id, 'active', days_ago(1)) for course_id in range(1, 6)])
+
+    # Fail inside the second batch, after the first one has committed
+    calls = []
+    def failing_keys(user_id, course_id):
+        calls.append(course_id)
+        if len(calls) == 3:
+            raise RuntimeError('batch failed')
+        return enrollment_cache_keys(user_id, course_id)
+    monkeypatch.setattr(maintenance, 'enrollment_cache_keys', failing_keys)
+
+    with pytest.raises(RuntimeError):
+        maintenance.expire_enrollments(batch_size=2, pause=0)
+
+    assert MaintenanceCheckpoint.query.get('expire_enrollments').last_id == ids[1]
+    assert list(statuses().values()) == ['expired', 'expired', 'active', 'active', 'active']
+
+    monkeypatch.setattr(maintenance, 'enrollment_cache_keys', enrollment_cache_keys)
+    stats = maintenance.expire_enrollments(batch_size=2, pause=0)
+
+    assert stats['rows'] == 3
+    assert set(statuses().values()) == {'expired'}
+
+def test_resume_skips_rows_before_checkpoint(session, invalidated):
+    ids = add_enrollments(session, *[(course_id, 'active', days_ago(1)) for course_id in range(1, 4)])
+    session.add(MaintenanceCheckpoint(job='expire_enrollments', last_id=ids[0]))
+    session.commit()
+
+    stats = maintenance.expire_enrollments(pause=0)
+
+    assert stats['rows'] == 2
+    assert list(statuses().values()) == ['active', 'expired', 'expired']
+
+def test_checkpoint_deleted_after_full_pass(session, invalidated):
+    add_enrollments(session, *[(course_id, 'active', days_ago(1)) for course_id in range(1, 6)])
+
+    stats = maintenance.expire_enrollments(batch_size=2, pause=0)
+
+    assert stats['rows'] == 5
+    assert stats['rows_per_second'] > 0
+    assert MaintenanceCheckpoint.query.count() == 0